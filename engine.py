@@ -0,0 +1,1138 @@
+import os
+import time
+import errno
+import shutil
+import threading
+import functools
+import libtorrent as lt
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+
+import rpc
+from rpc import EngineError
+
+# Torrent engine: the only process owning the libtorrent session and download state.
+# The HTTP workers talk to it through the calls registered in ENGINE_METHODS.
+
+# Global variables for torrent session
+torrent_session = lt.session()
+settings = torrent_session.get_settings()
+settings['listen_interfaces'] = '0.0.0.0:6881'
+# Alerts consumed by the background state loop (finish, recheck and move events)
+settings['alert_mask'] = (
+    lt.alert.category_t.error_notification
+    | lt.alert.category_t.status_notification
+    | lt.alert.category_t.storage_notification
+)
+torrent_session.apply_settings(settings)
+active_downloads: Dict[str, lt.torrent_handle] = {}
+download_info: Dict[str, dict] = {}
+
+# Events the completion workers and streams wait on, keyed by (download_id, alert kind)
+alert_events: Dict[tuple, list] = {}
+
+# Engine calls run on one thread each, state is only read and written while holding this lock.
+# Blocking waits (metadata, alerts) happen outside of it.
+engine_lock = threading.RLock()
+# Magnets reserved while their metadata is fetched, before they are tracked
+pending_downloads = set()
+
+# The last folder seen on each volume, keyed by device ID, used to query free space
+volume_paths: Dict[int, str] = {}
+
+# Optional completion pipeline: download into a staging folder and move or
+# hardlink finished torrents into the selected library folder
+STAGING_PATH = os.getenv('STAGING_PATH', '')
+COMPLETION_MODE = os.getenv('COMPLETION_MODE', 'move').lower()  # move | hardlink
+if COMPLETION_MODE not in ('move', 'hardlink'):
+    print(f"Warning: Ignoring invalid completion mode '{COMPLETION_MODE}', using 'move'")
+    COMPLETION_MODE = 'move'
+VERIFY_ON_COMPLETE = os.getenv('VERIFY_ON_COMPLETE', 'false').lower() == 'true'
+COMPLETION_WORKERS = max(1, int(os.getenv('COMPLETION_WORKERS', '1')))
+
+# Streaming mode: media files get their first and last pieces first so players
+# can read the container headers and start playback before the download is done
+MEDIA_EXTENSIONS = ('.mkv', '.mp4', '.m4v', '.avi', '.mov', '.webm', '.ts', '.wmv', '.flv')
+STREAM_HEAD_BYTES = 20 * 1024 * 1024
+STREAM_TAIL_BYTES = 5 * 1024 * 1024
+STREAM_READAHEAD_PIECES = 8
+STREAM_PIECE_TIMEOUT = 120  # Seconds to wait for a missing piece
+
+# Bandwidth limits in KB/s (0 = unlimited)
+# BANDWIDTH_SCHEDULE overrides the global limits during time windows, e.g. "18:00-23:30=2048/512"
+# BANDWIDTH_CLASSES defines per-download limits, e.g. "background=1024/128,priority=0/0"
+# BANDWIDTH_FOLDERS assigns a default class per folder, e.g. "/downloads/anime=background"
+DOWNLOAD_LIMIT = int(os.getenv('DOWNLOAD_LIMIT', '0'))
+UPLOAD_LIMIT = int(os.getenv('UPLOAD_LIMIT', '0'))
+BANDWIDTH_SCHEDULE = os.getenv('BANDWIDTH_SCHEDULE', '')
+BANDWIDTH_CLASSES = os.getenv('BANDWIDTH_CLASSES', '')
+BANDWIDTH_FOLDERS = os.getenv('BANDWIDTH_FOLDERS', '')
+STATE_CHECK_INTERVAL = 30  # Seconds between background state checks
+
+# Disk space: downloads are only admitted (and kept running) while they fit on their volumes
+# ALLOCATION_MODES overrides ALLOCATION_MODE per folder, e.g. "/downloads/movies=allocate,/staging=sparse"
+MIN_FREE_SPACE = int(os.getenv('MIN_FREE_SPACE', '1024'))  # MB always kept free on every volume
+ALLOCATION_MODE = os.getenv('ALLOCATION_MODE', 'sparse').lower()  # sparse | allocate
+if ALLOCATION_MODE not in ('sparse', 'allocate'):
+    print(f"Warning: Ignoring invalid allocation mode '{ALLOCATION_MODE}', using 'sparse'")
+    ALLOCATION_MODE = 'sparse'
+ALLOCATION_MODES = os.getenv('ALLOCATION_MODES', '')
+
+# Bounded pool so several finished torrents don't hit the library disk at once
+completion_pool = ThreadPoolExecutor(max_workers=COMPLETION_WORKERS, thread_name_prefix='completion')
+
+def locked(func):
+    """Run a function while holding the engine lock"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with engine_lock:
+            return func(*args, **kwargs)
+    return wrapper
+
+# Stages of the completion pipeline a finished download goes through
+PIPELINE_STAGES = ('queued', 'verifying', 'moving', 'linking')
+
+def get_save_path(internal_path: str, download_id: str) -> str:
+    """Get the folder libtorrent writes to (own staging subfolder if the pipeline is enabled)"""
+    if not STAGING_PATH:
+        return internal_path
+    # One subfolder per download so files of different torrents never collide
+    save_path = os.path.join(STAGING_PATH, download_id)
+    os.makedirs(save_path, exist_ok=True)
+    return save_path
+
+def remove_staging_folder(save_path: str):
+    """Delete the staging subfolder of a download, leaving library folders alone"""
+    if STAGING_PATH and os.path.dirname(os.path.normpath(save_path)) == os.path.normpath(STAGING_PATH):
+        shutil.rmtree(save_path, ignore_errors=True)
+
+def completion_pipeline_enabled() -> bool:
+    """Check if finished downloads go through the completion pipeline"""
+    return bool(STAGING_PATH) or VERIFY_ON_COMPLETE
+
+def find_download_id(handle: lt.torrent_handle):
+    """Get the download ID tracking the given torrent handle"""
+    for download_id, active_handle in list(active_downloads.items()):
+        if active_handle == handle:
+            return download_id
+    return None
+
+@locked
+def expect_alert(download_id: str, kind: str) -> threading.Event:
+    """Register an event that is set when the given alert arrives for a download"""
+    event = threading.Event()
+    event.data = None
+    alert_events.setdefault((download_id, kind), []).append(event)
+    return event
+
+@locked
+def notify_alert(download_id: str, kind: str, data=None):
+    """Wake up everyone waiting for the given alert, passing along its payload"""
+    for event in alert_events.pop((download_id, kind), []):
+        event.data = data
+        event.set()
+
+@locked
+def discard_alert(download_id: str, kind: str, event: threading.Event):
+    """Stop waiting for an alert that never arrived"""
+    events = alert_events.get((download_id, kind), [])
+    if event in events:
+        events.remove(event)
+    if not events:
+        alert_events.pop((download_id, kind), None)
+
+def wait_for_event(download_id: str, kind: str, handle: lt.torrent_handle, event: threading.Event) -> bool:
+    """Wait for an alert event, giving up if the torrent is removed meanwhile"""
+    while not event.wait(5):
+        if not handle.is_valid():
+            discard_alert(download_id, kind, event)
+            return False
+    return handle.is_valid()
+
+
+def link_files(handle: lt.torrent_handle, target_path: str):
+    """Hardlink the downloaded files into the target folder (copy across filesystems)"""
+    save_path = handle.status().save_path
+    torrent_info = handle.torrent_file()
+    file_storage = torrent_info.files()
+    links = []
+    for i in range(torrent_info.num_files()):
+        if handle.file_priority(i) == 0:
+            continue
+        relative_path = file_storage.file_path(i)
+        source = os.path.join(save_path, relative_path)
+        destination = os.path.join(target_path, relative_path)
+        # Padding files are never written to disk
+        if file_storage.file_flags(i) & lt.file_storage.flag_pad_file:
+            continue
+        if not os.path.exists(source):
+            raise FileNotFoundError(f"Downloaded file is missing: {relative_path}")
+        # Never replace media already in the library
+        if os.path.exists(destination):
+            raise FileExistsError(f"File already exists in the library: {relative_path}")
+        links.append((source, destination))
+    
+    created = []
+    try:
+        for source, destination in links:
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            try:
+                os.link(source, destination)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                # Track the copy before it starts so a partial file is removed too
+                created.append(destination)
+                shutil.copy2(source, destination)
+            else:
+                created.append(destination)
+    except Exception:
+        # Don't leave a half-linked download in the library
+        for destination in created:
+            try:
+                if os.path.exists(destination):
+                    os.remove(destination)
+            except OSError as e:
+                print(f"Error removing {destination}: {e}")
+        raise
+
+
+def run_completion_pipeline(download_id: str):
+    """Verify a finished download and move or hardlink it into its library folder"""
+    with engine_lock:
+        handle = active_downloads.get(download_id)
+        info = download_info.get(download_id)
+        if handle is None or info is None or not handle.is_valid():
+            return
+
+    try:
+        if VERIFY_ON_COMPLETE:
+            info['stage'] = 'verifying'
+            checked = expect_alert(download_id, 'checked')
+            handle.force_recheck()
+            if not wait_for_event(download_id, 'checked', handle, checked):
+                return
+            if not handle.status().is_finished:
+                # Failed pieces are downloaded again and the pipeline reruns on the next finish
+                info['stage'] = 'downloading'
+                return
+
+        target_path = info['path']
+        if STAGING_PATH and handle.status().save_path != target_path:
+            if COMPLETION_MODE == 'hardlink':
+                info['stage'] = 'linking'
+                link_files(handle, target_path)
+            else:
+                info['stage'] = 'moving'
+                moved = expect_alert(download_id, 'moved')
+                staging_path = handle.status().save_path
+                # Fail instead of replacing media already in the library
+                handle.move_storage(target_path, lt.move_flags_t.fail_if_exist)
+                if not wait_for_event(download_id, 'moved', handle, moved):
+                    return
+                if info.get('error'):
+                    info['stage'] = 'error'
+                    return
+                remove_staging_folder(staging_path)
+
+        info['stage'] = 'done'
+    except Exception as e:
+        print(f"Error processing completed download {download_id}: {e}")
+        info['stage'] = 'error'
+        info['error'] = str(e)
+
+
+def parse_limits(value: str) -> tuple:
+    """Parse a "download/upload" limit pair in KB/s"""
+    download, _, upload = value.partition('/')
+    return int(download), int(upload or 0)
+
+
+def parse_bandwidth_classes(value: str) -> Dict[str, tuple]:
+    """Parse "name=download/upload" entries into per-download bandwidth classes"""
+    classes = {}
+    for entry in filter(None, (e.strip() for e in value.split(','))):
+        try:
+            name, _, limits = entry.partition('=')
+            if not name.strip():
+                raise ValueError("missing class name")
+            classes[name.strip()] = parse_limits(limits)
+        except ValueError:
+            print(f"Warning: Ignoring invalid bandwidth class '{entry}'")
+    return classes
+
+
+def parse_bandwidth_schedule(value: str) -> list:
+    """Parse "HH:MM-HH:MM=download/upload" entries into (start, end, limits) rules in minutes"""
+    rules = []
+    for entry in filter(None, (e.strip() for e in value.split(','))):
+        try:
+            window, _, limits = entry.partition('=')
+            start_text, end_text = window.split('-')
+            start = datetime.strptime(start_text.strip(), '%H:%M')
+            end = datetime.strptime(end_text.strip(), '%H:%M')
+            rules.append((start.hour * 60 + start.minute, end.hour * 60 + end.minute, parse_limits(limits)))
+        except ValueError:
+            print(f"Warning: Ignoring invalid bandwidth schedule rule '{entry}'")
+    return rules
+
+
+def parse_bandwidth_folders(value: str) -> Dict[str, str]:
+    """Parse "folder=class" entries into per-folder default bandwidth classes"""
+    folders = {}
+    for entry in filter(None, (e.strip() for e in value.split(','))):
+        folder, _, bandwidth_class = entry.partition('=')
+        if bandwidth_class.strip() not in bandwidth_classes:
+            print(f"Warning: Ignoring bandwidth folder with unknown class '{entry}'")
+            continue
+        folders[folder.strip().rstrip('/')] = bandwidth_class.strip()
+    return folders
+
+
+def get_folder_setting(path: str, folder_settings: Dict[str, str], default):
+    """Get the setting of the most specific folder containing the path"""
+    setting, matched = default, ''
+    for folder, folder_setting in folder_settings.items():
+        if (path == folder or path.startswith(folder + '/')) and len(folder) > len(matched):
+            setting, matched = folder_setting, folder
+    return setting
+
+
+bandwidth_classes = parse_bandwidth_classes(BANDWIDTH_CLASSES)
+bandwidth_folders = parse_bandwidth_folders(BANDWIDTH_FOLDERS)
+bandwidth_schedule = parse_bandwidth_schedule(BANDWIDTH_SCHEDULE)
+bandwidth_state = {"download_limit": None, "upload_limit": None, "scheduled": False}
+
+
+def get_scheduled_limits(now: datetime) -> tuple:
+    """Get the global (download, upload) limits for the given time and whether a rule matched"""
+    minute = now.hour * 60 + now.minute
+    for start, end, limits in bandwidth_schedule:
+        # Windows ending before they start wrap around midnight
+        if start <= minute < end or (end < start and (minute >= start or minute < end)):
+            return limits, True
+    return (DOWNLOAD_LIMIT, UPLOAD_LIMIT), False
+
+
+@locked
+def apply_bandwidth_schedule():
+    """Apply the global limits for the current time if they changed"""
+    (download_limit, upload_limit), scheduled = get_scheduled_limits(datetime.now())
+    if (download_limit, upload_limit) == (bandwidth_state["download_limit"], bandwidth_state["upload_limit"]):
+        return
+    torrent_session.apply_settings({
+        'download_rate_limit': download_limit * 1024,
+        'upload_rate_limit': upload_limit * 1024
+    })
+    bandwidth_state.update({"download_limit": download_limit, "upload_limit": upload_limit, "scheduled": scheduled})
+
+
+def apply_bandwidth_class(handle: lt.torrent_handle, bandwidth_class: str):
+    """Cap a new download at the full limits of its class until the class budget is split"""
+    download_limit, upload_limit = bandwidth_classes[bandwidth_class]
+    handle.set_download_limit(download_limit * 1024)
+    handle.set_upload_limit(upload_limit * 1024)
+
+
+@locked
+def apply_bandwidth_classes():
+    """Split the limits of each bandwidth class evenly between the downloads using it"""
+    members = {}
+    for download_id, handle in list(active_downloads.items()):
+        bandwidth_class = download_info.get(download_id, {}).get('bandwidth_class')
+        if bandwidth_class in bandwidth_classes and handle.is_valid():
+            members.setdefault(bandwidth_class, []).append(handle)
+    
+    for bandwidth_class, handles in members.items():
+        download_limit, upload_limit = bandwidth_classes[bandwidth_class]
+        # A class limit is shared by all its downloads, 0 stays unlimited
+        download_share = max(1, download_limit * 1024 // len(handles)) if download_limit else 0
+        upload_share = max(1, upload_limit * 1024 // len(handles)) if upload_limit else 0
+        for handle in handles:
+            handle.set_download_limit(download_share)
+            handle.set_upload_limit(upload_share)
+
+
+def parse_allocation_modes(value: str) -> Dict[str, str]:
+    """Parse "folder=mode" entries into per-folder allocation modes"""
+    modes = {}
+    for entry in filter(None, (e.strip() for e in value.split(','))):
+        folder, _, mode = entry.partition('=')
+        if mode.strip().lower() not in ('sparse', 'allocate'):
+            print(f"Warning: Ignoring invalid allocation mode '{entry}'")
+            continue
+        modes[folder.strip().rstrip('/')] = mode.strip().lower()
+    return modes
+
+
+allocation_modes = parse_allocation_modes(ALLOCATION_MODES)
+
+
+def get_allocation_mode(save_path: str) -> str:
+    """Get the allocation mode of the most specific folder containing the save path"""
+    return get_folder_setting(save_path, allocation_modes, ALLOCATION_MODE)
+
+
+def get_storage_mode(save_path: str) -> lt.storage_mode_t:
+    """Get the libtorrent storage mode for a save path"""
+    if get_allocation_mode(save_path) == 'allocate':
+        return lt.storage_mode_t.storage_mode_allocate
+    return lt.storage_mode_t.storage_mode_sparse
+
+
+def get_volume(path: str) -> int:
+    """Get the device ID of the volume holding a path"""
+    device = os.stat(path).st_dev
+    # Keep the latest path, folders seen earlier may have been deleted since
+    volume_paths[device] = path
+    return device
+
+
+def get_wanted_size(torrent_info: lt.torrent_info, selected_files) -> int:
+    """Get the number of bytes of the files that will be downloaded"""
+    if selected_files is None:
+        return torrent_info.total_size()
+    file_storage = torrent_info.files()
+    return sum(file_storage.file_size(i) for i in range(torrent_info.num_files()) if i in selected_files)
+
+
+def get_allocated_size(handle: lt.torrent_handle, save_path: str) -> int:
+    """Get the bytes the selected files of a download actually take on disk"""
+    torrent_info = handle.torrent_file()
+    if not torrent_info:
+        return 0
+    file_storage = torrent_info.files()
+    allocated = 0
+    for i in range(torrent_info.num_files()):
+        if handle.file_priority(i) == 0 or file_storage.file_flags(i) & lt.file_storage.flag_pad_file:
+            continue
+        try:
+            stat = os.stat(os.path.join(save_path, file_storage.file_path(i)))
+        except FileNotFoundError:
+            continue
+        allocated += min(stat.st_blocks * 512, file_storage.file_size(i))
+    return allocated
+
+
+def get_space_needs(save_path: str, target_path: str, total: int, remaining: int, stage) -> Dict[int, int]:
+    """Get the bytes a download still has to write, per volume"""
+    save_volume = get_volume(save_path)
+    needs = {save_volume: remaining}
+    if STAGING_PATH and stage != 'done':
+        target_volume = get_volume(target_path)
+        if target_volume != save_volume:
+            # Moving or linking across filesystems copies the whole download
+            needs[target_volume] = needs.get(target_volume, 0) + total
+    return needs
+
+
+def get_download_space_needs(download_id: str, handle: lt.torrent_handle) -> Dict[int, int]:
+    """Get the bytes a tracked download still has to write, per volume"""
+    status = handle.status()
+    info = download_info.get(download_id, {})
+    if get_allocation_mode(status.save_path) == 'allocate':
+        # libtorrent only reserves a file on its first write, count what is really on disk
+        remaining = max(0, status.total_wanted - get_allocated_size(handle, status.save_path))
+    else:
+        remaining = status.total_wanted - status.total_wanted_done
+    return get_space_needs(
+        status.save_path, info.get('path', status.save_path), status.total_wanted,
+        remaining, info.get('stage')
+    )
+
+
+def get_available_space(volume: int, committed: Dict[int, int]) -> int:
+    """Get the free bytes of a volume not yet promised to other downloads or the reserve"""
+    free = shutil.disk_usage(volume_paths[volume]).free
+    return free - committed.get(volume, 0) - MIN_FREE_SPACE * 1024 * 1024
+
+
+def uses_disk_space(download_id: str, handle: lt.torrent_handle) -> bool:
+    """Check if a download is still writing new data and counts towards disk space"""
+    # Downloads in the completion pipeline or being rechecked are already on disk,
+    # their wanted bytes restart from 0 during a recheck and must not be counted again
+    if download_info.get(download_id, {}).get('stage') not in (None, 'downloading'):
+        return False
+    return handle.status().state != lt.torrent_status.checking_files
+
+
+def get_committed_space() -> Dict[int, int]:
+    """Get the bytes still to be written by running downloads, per volume"""
+    committed = {}
+    for download_id, handle in list(active_downloads.items()):
+        if not handle.is_valid() or download_info.get(download_id, {}).get('paused_for_space'):
+            continue
+        try:
+            if not uses_disk_space(download_id, handle):
+                continue
+            needs = get_download_space_needs(download_id, handle)
+        except OSError as e:
+            print(f"Error checking disk space of download {download_id}: {e}")
+            continue
+        for volume, needed in needs.items():
+            committed[volume] = committed.get(volume, 0) + needed
+    return committed
+
+
+def check_admission(save_path: str, target_path: str, wanted: int):
+    """Refuse a new download that does not fit next to the downloads already running"""
+    committed = get_committed_space()
+    for volume, needed in get_space_needs(save_path, target_path, wanted, wanted, None).items():
+        shortage = needed - get_available_space(volume, committed)
+        if shortage > 0:
+            raise EngineError(507, f"Not enough disk space: {shortage / (1024 ** 3):.2f} GB more is needed in {volume_paths[volume]}")
+
+
+def pause_for_space(download_id: str, handle: lt.torrent_handle):
+    """Pause a download until enough disk space is available"""
+    # Auto-managed torrents would be resumed by the session queue
+    handle.unset_flags(lt.torrent_flags.auto_managed)
+    handle.pause()
+    download_info[download_id]['paused_for_space'] = True
+    print(f"Paused download {download_id}: not enough disk space")
+
+
+def resume_after_space(download_id: str, handle: lt.torrent_handle):
+    """Resume a download paused for disk space"""
+    handle.set_flags(lt.torrent_flags.auto_managed)
+    handle.resume()
+    download_info[download_id]['paused_for_space'] = False
+    print(f"Resumed download {download_id}: disk space available")
+
+
+@locked
+def check_disk_space():
+    """Pause downloads that no longer fit on their volumes and resume them once space is freed"""
+    downloads = [
+        (download_id, handle) for download_id, handle in list(active_downloads.items())
+        if handle.is_valid() and download_id in download_info
+    ]
+    # Oldest downloads get the space first so newer ones are the ones paused
+    downloads.sort(key=lambda item: download_info[item[0]].get('start_time', 0))
+    
+    committed = {}
+    for download_id, handle in downloads:
+        status = handle.status()
+        if not status.has_metadata or not uses_disk_space(download_id, handle):
+            continue
+        try:
+            needs = get_download_space_needs(download_id, handle)
+            fits = status.is_finished or all(needed <= get_available_space(volume, committed) for volume, needed in needs.items())
+        except OSError as e:
+            print(f"Error checking disk space of download {download_id}: {e}")
+            continue
+        if fits:
+            for volume, needed in needs.items():
+                committed[volume] = committed.get(volume, 0) + needed
+            if download_info[download_id].get('paused_for_space'):
+                resume_after_space(download_id, handle)
+        elif not download_info[download_id].get('paused_for_space'):
+            pause_for_space(download_id, handle)
+
+
+def is_media_file(path: str) -> bool:
+    """Check if a file is a video that can be streamed"""
+    return path.lower().endswith(MEDIA_EXTENSIONS)
+
+
+def get_piece_range(torrent_info: lt.torrent_info, file_index: int, offset: int, length: int) -> range:
+    """Get the pieces covering a byte range of a file"""
+    file_storage = torrent_info.files()
+    start = file_storage.file_offset(file_index) + offset
+    piece_length = torrent_info.piece_length()
+    return range(start // piece_length, (start + length - 1) // piece_length + 1)
+
+
+def enable_streaming(handle: lt.torrent_handle):
+    """Download sequentially and fetch the head and tail of selected media files first"""
+    handle.set_flags(lt.torrent_flags.sequential_download)
+    torrent_info = handle.torrent_file()
+    file_storage = torrent_info.files()
+    for i in range(torrent_info.num_files()):
+        file_size = file_storage.file_size(i)
+        if file_size == 0 or handle.file_priority(i) == 0 or not is_media_file(file_storage.file_path(i)):
+            continue
+        head = get_piece_range(torrent_info, i, 0, min(STREAM_HEAD_BYTES, file_size))
+        tail_length = min(STREAM_TAIL_BYTES, file_size)
+        tail = get_piece_range(torrent_info, i, file_size - tail_length, tail_length)
+        # Staggered deadlines keep the head in order, the tail is needed right after it
+        for position, piece in enumerate(head):
+            handle.set_piece_deadline(piece, 1000 + position * 200)
+        for position, piece in enumerate(tail):
+            handle.set_piece_deadline(piece, 1500 + position * 200)
+
+
+def read_piece(download_id: str, handle: lt.torrent_handle, piece: int) -> bytes:
+    """Read a piece of an active download, waiting until it has been downloaded"""
+    event = expect_alert(download_id, f"piece:{piece}")
+    if handle.have_piece(piece):
+        handle.read_piece(piece)
+    else:
+        # libtorrent posts a read_piece_alert as soon as the piece is downloaded
+        handle.set_piece_deadline(piece, 0, lt.deadline_flags_t.alert_when_available)
+    if not event.wait(STREAM_PIECE_TIMEOUT):
+        discard_alert(download_id, f"piece:{piece}", event)
+        raise TimeoutError(f"Piece {piece} is not available")
+    if event.data is None:
+        raise TimeoutError(f"Piece {piece} is not available")
+    return event.data
+
+
+@locked
+def handle_alert(alert):
+    """Dispatch a single libtorrent alert"""
+    if not hasattr(alert, 'handle'):
+        return
+    download_id = find_download_id(alert.handle)
+    if download_id is None:
+        return
+
+    if isinstance(alert, lt.torrent_finished_alert):
+        info = download_info.get(download_id)
+        # Rechecks also post a finished alert, only queue downloads not already in the pipeline
+        if completion_pipeline_enabled() and info is not None and info.get('stage') in (None, 'downloading'):
+            info['stage'] = 'queued'
+            completion_pool.submit(run_completion_pipeline, download_id)
+    elif isinstance(alert, lt.metadata_received_alert):
+        # Magnets added without waiting for metadata are checked as soon as their size is known
+        check_disk_space()
+    elif isinstance(alert, lt.torrent_checked_alert):
+        notify_alert(download_id, 'checked')
+    elif isinstance(alert, lt.storage_moved_alert):
+        notify_alert(download_id, 'moved')
+    elif isinstance(alert, lt.read_piece_alert):
+        data = None if alert.error.value() else bytes(alert.buffer)
+        notify_alert(download_id, f"piece:{alert.piece}", data)
+    elif isinstance(alert, lt.storage_moved_failed_alert):
+        if download_id in download_info:
+            download_info[download_id]['error'] = f"Error moving files: {alert.message()}"
+        notify_alert(download_id, 'moved')
+
+
+def torrent_state_loop():
+    """Background loop that processes libtorrent alerts and periodic state checks"""
+    last_check = 0
+    while True:
+        torrent_session.wait_for_alert(1000)
+        for alert in torrent_session.pop_alerts():
+            try:
+                handle_alert(alert)
+            except Exception as e:
+                print(f"Error handling alert {alert.what()}: {e}")
+        
+        if time.time() - last_check < STATE_CHECK_INTERVAL:
+            continue
+        last_check = time.time()
+        try:
+            apply_bandwidth_schedule()
+            apply_bandwidth_classes()
+        except Exception as e:
+            print(f"Error applying bandwidth limits: {e}")
+        try:
+            check_disk_space()
+        except Exception as e:
+            print(f"Error checking disk space: {e}")
+
+
+def apply_file_options(handle: lt.torrent_handle, selected_files, skip_parent_folder: bool, flatten_all: bool):
+    """Apply file selection and folder options to a torrent with metadata"""
+    torrent_info = handle.torrent_file()
+    if not torrent_info:
+        return
+    
+    # Handle file selection
+    if selected_files is not None:
+        num_files = torrent_info.num_files()
+        # Set file priorities: 0 = don't download, 4 = normal priority
+        for i in range(num_files):
+            if i in selected_files:
+                handle.file_priority(i, 4)
+            else:
+                handle.file_priority(i, 0)
+    
+    # Handle skip parent folder option or flatten all
+    file_storage = torrent_info.files()
+    for i in range(torrent_info.num_files()):
+        original_path = file_storage.file_path(i)
+        
+        if flatten_all:
+            # Flatten all - keep only the filename
+            new_path = os.path.basename(original_path)
+            handle.rename_file(i, new_path)
+        elif skip_parent_folder:
+            # Remove only the first directory from the path
+            path_parts = original_path.split('/', 1)
+            if len(path_parts) > 1:
+                new_path = path_parts[1]
+                handle.rename_file(i, new_path)
+
+
+def track_download(download_id: str, handle: lt.torrent_handle, name: str, internal_path: str, bandwidth_class: str):
+    """Start tracking a newly added download"""
+    active_downloads[download_id] = handle
+    download_info[download_id] = {
+        "status": "downloading",
+        "progress": 0,
+        "name": name,
+        "download_rate": 0,
+        "upload_rate": 0,
+        "path": internal_path,
+        "stage": None,
+        "paused_for_space": False,
+        "bandwidth_class": bandwidth_class,
+        "start_time": datetime.now().timestamp()
+    }
+    if bandwidth_class:
+        apply_bandwidth_classes()
+
+
+def add_magnet(magnet_link: str, internal_path: str, selected_files, skip_parent_folder: bool,
+               flatten_all: bool, streaming: bool, bandwidth_class: str) -> str:
+    """Start downloading a torrent from magnet link"""
+    try:
+        # Downloads without an explicit class get the default class of their folder
+        bandwidth_class = bandwidth_class or get_folder_setting(internal_path, bandwidth_folders, None)
+        if bandwidth_class and bandwidth_class not in bandwidth_classes:
+            raise EngineError(400, f"Unknown bandwidth class: {bandwidth_class}")
+        
+        # Generate download ID
+        download_id = str(hash(magnet_link))[:16]
+        with engine_lock:
+            if download_id in active_downloads or download_id in pending_downloads:
+                raise EngineError(409, "This torrent is already being downloaded")
+            # Reserve the ID while waiting for metadata so the same magnet can't be added twice
+            pending_downloads.add(download_id)
+        
+        try:
+            with engine_lock:
+                # Add torrent
+                save_path = get_save_path(internal_path, download_id)
+                params = {
+                    'save_path': save_path,
+                    'storage_mode': get_storage_mode(save_path),
+                }
+                
+                try:
+                    handle = lt.add_magnet_uri(torrent_session, magnet_link, params)
+                except Exception as e:
+                    remove_staging_folder(save_path)
+                    raise EngineError(400, f"Invalid magnet link: {str(e)}")
+                
+                # Verify handle is valid
+                if not handle.is_valid():
+                    remove_staging_folder(save_path)
+                    raise EngineError(400, "Failed to add magnet link - invalid torrent")
+                
+                if bandwidth_class:
+                    apply_bandwidth_class(handle, bandwidth_class)
+                
+                wait_for_metadata = selected_files is not None or skip_parent_folder or streaming
+                if wait_for_metadata:
+                    # Fetch metadata without writing any data until the download is admitted
+                    handle.set_flags(lt.torrent_flags.upload_mode)
+            
+            # Wait for metadata if we need to select files (without holding the engine lock)
+            if wait_for_metadata:
+                max_wait = 30
+                start_time = time.time()
+                
+                while not handle.has_metadata():
+                    if time.time() - start_time > max_wait:
+                        torrent_session.remove_torrent(handle)
+                        remove_staging_folder(save_path)
+                        raise EngineError(408, "Timeout waiting for torrent metadata")
+                    time.sleep(0.1)
+            
+            with engine_lock:
+                if handle.has_metadata():
+                    # Refuse downloads that can never finish, the metadata is needed to know their size
+                    try:
+                        check_admission(save_path, internal_path, get_wanted_size(handle.torrent_file(), selected_files))
+                    except EngineError:
+                        torrent_session.remove_torrent(handle)
+                        remove_staging_folder(save_path)
+                        raise
+                    
+                    apply_file_options(handle, selected_files, skip_parent_folder, flatten_all)
+                    # Streaming mode needs the file priorities set above
+                    if streaming:
+                        enable_streaming(handle)
+                
+                if wait_for_metadata:
+                    # Admitted with its files selected, start downloading
+                    handle.unset_flags(lt.torrent_flags.upload_mode)
+                
+                track_download(download_id, handle, "Fetching metadata...", internal_path, bandwidth_class)
+                return download_id
+        finally:
+            with engine_lock:
+                pending_downloads.discard(download_id)
+    except EngineError:
+        raise
+    except Exception as e:
+        raise EngineError(500, f"Error starting download: {str(e)}")
+
+
+@locked
+def add_torrent_file(torrent_data: bytes, internal_path: str, selected_files, skip_parent_folder: bool,
+                     flatten_all: bool, streaming: bool, bandwidth_class: str) -> str:
+    """Start downloading a torrent from the contents of a .torrent file"""
+    try:
+        # Downloads without an explicit class get the default class of their folder
+        bandwidth_class = bandwidth_class or get_folder_setting(internal_path, bandwidth_folders, None)
+        if bandwidth_class and bandwidth_class not in bandwidth_classes:
+            raise EngineError(400, f"Unknown bandwidth class: {bandwidth_class}")
+        
+        # Create torrent info from the file data
+        try:
+            torrent_info = lt.torrent_info(torrent_data)
+        except Exception as e:
+            raise EngineError(400, f"Invalid torrent file: {str(e)}")
+        
+        # Generate download ID from torrent info hash
+        download_id = str(torrent_info.info_hash())[:16]
+        if download_id in active_downloads or download_id in pending_downloads:
+            raise EngineError(409, "This torrent is already being downloaded")
+        
+        # Refuse downloads that can never finish before adding them
+        save_path = get_save_path(internal_path, download_id)
+        try:
+            check_admission(save_path, internal_path, get_wanted_size(torrent_info, selected_files))
+        except EngineError:
+            remove_staging_folder(save_path)
+            raise
+        
+        # Add torrent to session
+        params = {
+            'save_path': save_path,
+            'storage_mode': get_storage_mode(save_path),
+            'ti': torrent_info
+        }
+        
+        try:
+            handle = torrent_session.add_torrent(params)
+        except Exception as e:
+            remove_staging_folder(save_path)
+            raise EngineError(400, f"Failed to add torrent: {str(e)}")
+        
+        # Verify handle is valid
+        if not handle.is_valid():
+            remove_staging_folder(save_path)
+            raise EngineError(400, "Failed to add torrent - invalid torrent")
+        
+        if bandwidth_class:
+            apply_bandwidth_class(handle, bandwidth_class)
+        
+        apply_file_options(handle, selected_files, skip_parent_folder, flatten_all)
+        if streaming:
+            enable_streaming(handle)
+        
+        track_download(download_id, handle, torrent_info.name(), internal_path, bandwidth_class)
+        return download_id
+    except EngineError:
+        raise
+    except Exception as e:
+        raise EngineError(500, f"Error starting download: {str(e)}")
+
+
+@locked
+def get_progress(download_id: str) -> dict:
+    """Get download progress for a specific torrent"""
+    if download_id not in active_downloads:
+        raise EngineError(404, "Download not found")
+    
+    handle = active_downloads[download_id]
+    
+    # Check if handle is valid
+    if not handle.is_valid():
+        # Remove invalid handle
+        del active_downloads[download_id]
+        if download_id in download_info:
+            download_info[download_id]["status"] = "error"
+        raise EngineError(410, "Download failed or was removed")
+    
+    status = handle.status()
+    
+    # Check for errors
+    if status.error:
+        error_msg = status.error
+        download_info[download_id] = {
+            "status": "error",
+            "progress": status.progress * 100,
+            "name": status.name or "Unknown",
+            "download_rate": 0,
+            "upload_rate": 0,
+            "num_seeds": 0,
+            "num_peers": 0,
+            "total_download": 0,
+            "total_upload": 0,
+            "error": error_msg
+        }
+        # Remove from active downloads
+        del active_downloads[download_id]
+        return download_info[download_id]
+    
+    # Get total size from torrent info (only for files with priority > 0)
+    total_size = 0
+    try:
+        torrent_info = handle.torrent_file()
+        if torrent_info:
+            num_files = torrent_info.num_files()
+            file_storage = torrent_info.files()
+            # Calculate size only for files that are being downloaded
+            for i in range(num_files):
+                if handle.file_priority(i) > 0:
+                    total_size += file_storage.file_size(i)
+            total_size = total_size / (1024 * 1024)  # Convert to MB
+            
+            # If no files have priority set (all selected), use total size
+            if total_size == 0:
+                total_size = torrent_info.total_size() / (1024 * 1024)
+    except:
+        pass
+    
+    # Calculate ETA
+    eta_seconds = 0
+    if status.download_rate > 0 and total_size > 0:
+        remaining_mb = total_size - (status.total_download / (1024 * 1024))
+        remaining_bytes = remaining_mb * 1024 * 1024
+        eta_seconds = int(remaining_bytes / status.download_rate)
+    
+    # Calculate elapsed time
+    elapsed_seconds = 0
+    start_time = None
+    if download_id in download_info and 'start_time' in download_info[download_id]:
+        start_time = download_info[download_id]['start_time']
+        elapsed_seconds = int(datetime.now().timestamp() - start_time)
+    
+    # Finished downloads stay in processing until the completion pipeline is done
+    stage = download_info.get(download_id, {}).get('stage')
+    if stage == 'error':
+        download_info[download_id]["status"] = "error"
+        return {
+            "status": "error",
+            "progress": status.progress * 100,
+            "name": status.name or "Unknown",
+            "error": download_info[download_id].get('error', 'Error processing completed download')
+        }
+    if download_info.get(download_id, {}).get('paused_for_space'):
+        status_text = "paused"
+    elif stage in PIPELINE_STAGES:
+        # Rechecks reset is_finished, the download is still being processed
+        status_text = "processing"
+    elif not status.is_finished:
+        status_text = "downloading"
+    elif completion_pipeline_enabled() and stage != 'done':
+        status_text = "processing"
+    else:
+        status_text = "completed"
+    
+    info = {
+        "status": status_text,
+        "progress": status.progress * 100,
+        "name": status.name,
+        "download_rate": status.download_rate / 1024,  # KB/s
+        "upload_rate": status.upload_rate / 1024,  # KB/s
+        "num_seeds": status.num_seeds,
+        "num_peers": status.num_peers,
+        "total_download": status.total_download / (1024 * 1024),  # MB
+        "total_upload": status.total_upload / (1024 * 1024),  # MB
+        "total_size": total_size,  # MB
+        "eta_seconds": eta_seconds,  # Estimated time remaining in seconds
+        "elapsed_seconds": elapsed_seconds,  # Time elapsed since download started
+        "start_time": start_time,  # Preserve start time for future calculations
+    }
+    
+    download_info.setdefault(download_id, {}).update(info)
+    info["stage"] = stage
+    
+    return info
+
+
+@locked
+def cancel_download(download_id: str):
+    """Cancel an active download and delete partial files"""
+    if download_id not in active_downloads:
+        raise EngineError(404, "Download not found")
+    
+    handle = active_downloads[download_id]
+    
+    # Get torrent info before removing
+    try:
+        status = handle.status()
+        torrent_info = handle.torrent_file()
+        save_path = status.save_path
+        
+        # Get the name/folder of the download
+        if torrent_info:
+            download_name = torrent_info.name()
+        else:
+            download_name = status.name
+        
+        # Remove torrent from session with delete files option
+        torrent_session.remove_torrent(handle, lt.options_t.delete_files)
+        
+        # Additional cleanup: manually delete the folder/file if it still exists
+        if download_name and save_path:
+            download_path = os.path.join(save_path, download_name)
+            if os.path.exists(download_path):
+                try:
+                    if os.path.isfile(download_path):
+                        os.remove(download_path)
+                    elif os.path.isdir(download_path):
+                        shutil.rmtree(download_path)
+                except Exception as e:
+                    print(f"Error deleting files: {e}")
+        remove_staging_folder(save_path)
+    except Exception as e:
+        print(f"Error during cleanup: {e}")
+        # Still remove from tracking even if cleanup fails
+        torrent_session.remove_torrent(handle)
+    
+    del active_downloads[download_id]
+    if download_id in download_info:
+        download_info[download_id]["status"] = "cancelled"
+        if download_info[download_id].get("bandwidth_class"):
+            apply_bandwidth_classes()
+    
+    # Wake up streams and workers still waiting on alerts of the removed torrent
+    for pending_id, kind in [key for key in list(alert_events) if key[0] == download_id]:
+        notify_alert(pending_id, kind)
+
+
+@locked
+def remove_completed_downloads():
+    """Stop tracking completed downloads to free up memory"""
+    completed_ids = [download_id for download_id, info in download_info.items() if info.get('status') == 'completed']
+    for download_id in completed_ids:
+        active_downloads.pop(download_id, None)
+        download_info.pop(download_id, None)
+
+
+@locked
+def get_bandwidth() -> dict:
+    """Get the current global limits, the schedule and the available bandwidth classes (KB/s)"""
+    return {
+        "download_limit": bandwidth_state["download_limit"],
+        "upload_limit": bandwidth_state["upload_limit"],
+        "scheduled": bandwidth_state["scheduled"],
+        "schedule": [
+            {
+                "start": f"{start // 60:02d}:{start % 60:02d}",
+                "end": f"{end // 60:02d}:{end % 60:02d}",
+                "download_limit": limits[0],
+                "upload_limit": limits[1]
+            }
+            for start, end, limits in bandwidth_schedule
+        ],
+        "classes": {
+            name: {"download_limit": limits[0], "upload_limit": limits[1]}
+            for name, limits in bandwidth_classes.items()
+        }
+    }
+
+
+@locked
+def set_bandwidth_class(download_id: str, bandwidth_class: str):
+    """Change the bandwidth class of an active download"""
+    if download_id not in active_downloads:
+        raise EngineError(404, "Download not found")
+    if bandwidth_class and bandwidth_class not in bandwidth_classes:
+        raise EngineError(400, f"Unknown bandwidth class: {bandwidth_class}")
+    
+    handle = active_downloads[download_id]
+    if bandwidth_class:
+        apply_bandwidth_class(handle, bandwidth_class)
+    else:
+        handle.set_download_limit(-1)
+        handle.set_upload_limit(-1)
+    
+    if download_id in download_info:
+        download_info[download_id]["bandwidth_class"] = bandwidth_class
+    apply_bandwidth_classes()
+
+
+@locked
+def get_stream_file(download_id: str, file_index: int) -> dict:
+    """Get the path and size of a file that can be streamed"""
+    if download_id not in active_downloads:
+        raise EngineError(404, "Download not found")
+    
+    handle = active_downloads[download_id]
+    if not handle.is_valid():
+        raise EngineError(410, "Download failed or was removed")
+    
+    torrent_info = handle.torrent_file()
+    if not torrent_info:
+        raise EngineError(409, "Torrent metadata not available yet")
+    if file_index < 0 or file_index >= torrent_info.num_files():
+        raise EngineError(404, "File not found")
+    if handle.file_priority(file_index) == 0:
+        raise EngineError(400, "File is not selected for download")
+    
+    return {
+        "path": torrent_info.files().file_path(file_index),
+        "size": torrent_info.files().file_size(file_index)
+    }
+
+
+def read_file_chunk(download_id: str, file_index: int, start: int, end: int) -> bytes:
+    """Read the bytes of a file range that fall in the piece containing start, waiting for it if needed"""
+    # Only the checks hold the engine lock, waiting for the piece does not
+    with engine_lock:
+        if download_id not in active_downloads:
+            raise EngineError(404, "Download not found")
+        
+        handle = active_downloads[download_id]
+        if not handle.is_valid():
+            raise EngineError(410, "Download failed or was removed")
+        
+        torrent_info = handle.torrent_file()
+        if not torrent_info:
+            raise EngineError(409, "Torrent metadata not available yet")
+        piece_length = torrent_info.piece_length()
+        file_offset = torrent_info.files().file_offset(file_index)
+        position = file_offset + start
+        stop = file_offset + end + 1
+        piece = position // piece_length
+        
+        # Keep the pieces right after the playback position coming in
+        for ahead in range(1, STREAM_READAHEAD_PIECES + 1):
+            if piece + ahead < torrent_info.num_pieces() and not handle.have_piece(piece + ahead):
+                handle.set_piece_deadline(piece + ahead, ahead * 500)
+        
+    try:
+        data = read_piece(download_id, handle, piece)
+    except TimeoutError as e:
+        if not handle.is_valid():
+            raise EngineError(410, "Download failed or was removed")
+        raise EngineError(504, str(e))
+    piece_start = piece * piece_length
+    return data[position - piece_start:stop - piece_start]
+
+
+ENGINE_METHODS = {
+    "ping": lambda: "pong",
+    "add_magnet": add_magnet,
+    "add_torrent_file": add_torrent_file,
+    "get_progress": get_progress,
+    "cancel_download": cancel_download,
+    "remove_completed_downloads": remove_completed_downloads,
+    "get_bandwidth": get_bandwidth,
+    "set_bandwidth_class": set_bandwidth_class,
+    "get_stream_file": get_stream_file,
+    "read_file_chunk": read_file_chunk,
+}
+
+
+def serve():
+    """Run the torrent engine until the process exits"""
+    if STAGING_PATH:
+        os.makedirs(STAGING_PATH, exist_ok=True)
+    threading.Thread(target=torrent_state_loop, name='torrent-state', daemon=True).start()
+    rpc.serve(ENGINE_METHODS)
+
+
+if __name__ == "__main__":
+    serve()
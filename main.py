@@ -1,25 +1,21 @@
 import os
+import json
+import mimetypes
 import libtorrent as lt
-import shutil
 import requests
 import xml.etree.ElementTree as ET
 from datetime import datetime
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from typing import Dict
 from plexapi.server import PlexServer
 
-app = FastAPI()
+import rpc
+from rpc import EngineError
 
-# Global variables for torrent session
-torrent_session = lt.session()
-settings = torrent_session.get_settings()
-settings['listen_interfaces'] = '0.0.0.0:6881'
-torrent_session.apply_settings(settings)
-active_downloads: Dict[str, lt.torrent_handle] = {}
-download_info: Dict[str, dict] = {}
+app = FastAPI()
 
 # Plex connection from environment variables
 plex = None
@@ -39,6 +35,11 @@ except Exception as e:
 # Base path for downloads (internal container path)
 BASE_PATH = "/downloads"
 
+# Number of HTTP worker processes, all sharing the single torrent engine process
+WORKERS = max(1, int(os.getenv('WORKERS', '1')))
+
+mimetypes.add_type('video/x-matroska', '.mkv')
+
 def get_display_path(internal_path: str) -> str:
     """Convert internal path to display path by removing /downloads prefix"""
     if internal_path.startswith(BASE_PATH):
@@ -52,6 +53,43 @@ def get_internal_path(display_path: str) -> str:
         return BASE_PATH
     return BASE_PATH + display_path
 
+def parse_range_header(range_header: str, file_size: int):
+    """Parse an HTTP Range header into an inclusive (start, end) byte range"""
+    units, _, ranges = range_header.partition('=')
+    if units.strip() != 'bytes' or ',' in ranges:
+        return None
+    start_text, _, end_text = ranges.strip().partition('-')
+    try:
+        if start_text:
+            start = int(start_text)
+            end = int(end_text) if end_text else file_size - 1
+        else:
+            # Suffix range: the last N bytes of the file
+            start = max(0, file_size - int(end_text))
+            end = file_size - 1
+    except ValueError:
+        return None
+    end = min(end, file_size - 1)
+    if start > end:
+        return None
+    return start, end
+
+
+async def call_engine(method: str, *args):
+    """Call the torrent engine without blocking the event loop"""
+    return await run_in_threadpool(rpc.call, method, *args)
+
+
+def iter_stream(download_id: str, file_index: int, start: int, end: int):
+    """Yield the bytes of a file range as the engine gets their pieces"""
+    position = start
+    while position <= end:
+        chunk = rpc.call('read_file_chunk', download_id, file_index, position, end)
+        if not chunk:
+            break
+        yield chunk
+        position += len(chunk)
+
 
 class MagnetRequest(BaseModel):
     magnet_link: str
@@ -59,12 +97,19 @@ class MagnetRequest(BaseModel):
     selected_files: list = None  # List of file indices to download
     skip_parent_folder: bool = False  # Skip creating parent folder
     flatten_all: bool = False  # Flatten all subdirectories
+    streaming: bool = False  # Prioritise media files for preview while downloading
+    bandwidth_class: str = None  # Name of a bandwidth class from BANDWIDTH_CLASSES
 
 
 class CancelRequest(BaseModel):
     download_id: str
 
 
+class BandwidthClassRequest(BaseModel):
+    download_id: str
+    bandwidth_class: str = None  # None removes the per-download limits
+
+
 class PlexRefreshRequest(BaseModel):
     library_name: str
 
@@ -73,6 +118,22 @@ class TorrentInfoRequest(BaseModel):
     magnet_link: str = None
 
 
+@app.exception_handler(EngineError)
+async def engine_error_handler(request: Request, exc: EngineError):
+    """Report torrent engine errors like HTTPException does"""
+    return JSONResponse(status_code=exc.status_code, content={"detail": exc.detail})
+
+
+@app.on_event("startup")
+async def check_engine():
+    """Warn when the torrent engine is not running"""
+    try:
+        await call_engine('ping')
+    except EngineError as e:
+        print(f"Warning: {e.detail}. The torrent engine is started by 'python main.py'; "
+              f"when running the app another way, start it with 'python engine.py' using the same ENGINE_AUTHKEY")
+
+
 @app.get("/")
 async def read_index():
     return FileResponse('web/index.html')
@@ -358,97 +419,26 @@ async def list_folders(path: str = None):
 @app.post("/api/download")
 async def start_download(request: MagnetRequest):
     """Start downloading a torrent from magnet link"""
-    try:
-        # Validate magnet link format
-        if not request.magnet_link or not request.magnet_link.startswith('magnet:'):
-            raise HTTPException(status_code=400, detail="Invalid magnet link format")
-        
-        # Convert display path to internal path
-        internal_path = get_internal_path(request.download_path)
-        
-        # Validate download path
-        if not os.path.exists(internal_path):
-            raise HTTPException(status_code=404, detail="Download path not found")
-        
-        # Add torrent
-        params = {
-            'save_path': internal_path,
-            'storage_mode': lt.storage_mode_t.storage_mode_sparse,
-        }
-        
-        try:
-            handle = lt.add_magnet_uri(torrent_session, request.magnet_link, params)
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Invalid magnet link: {str(e)}")
-        
-        # Verify handle is valid
-        if not handle.is_valid():
-            raise HTTPException(status_code=400, detail="Failed to add magnet link - invalid torrent")
-        
-        # Wait for metadata if we need to select files
-        if request.selected_files is not None or request.skip_parent_folder:
-            import time
-            max_wait = 30
-            start_time = time.time()
-            
-            while not handle.has_metadata():
-                if time.time() - start_time > max_wait:
-                    torrent_session.remove_torrent(handle)
-                    raise HTTPException(status_code=408, detail="Timeout waiting for torrent metadata")
-                time.sleep(0.1)
-        
-        # Handle file selection
-        if request.selected_files is not None and handle.has_metadata():
-            torrent_info = handle.torrent_file()
-            if torrent_info:
-                num_files = torrent_info.num_files()
-                # Set file priorities: 0 = don't download, 4 = normal priority
-                for i in range(num_files):
-                    if i in request.selected_files:
-                        handle.file_priority(i, 4)
-                    else:
-                        handle.file_priority(i, 0)
-        
-        # Handle skip parent folder option or flatten all
-        if handle.has_metadata():
-            torrent_info = handle.torrent_file()
-            if torrent_info:
-                file_storage = torrent_info.files()
-                for i in range(torrent_info.num_files()):
-                    original_path = file_storage.file_path(i)
-                    
-                    if request.flatten_all:
-                        # Flatten all - keep only the filename
-                        new_path = os.path.basename(original_path)
-                        handle.rename_file(i, new_path)
-                    elif request.skip_parent_folder:
-                        # Remove only the first directory from the path
-                        path_parts = original_path.split('/', 1)
-                        if len(path_parts) > 1:
-                            new_path = path_parts[1]
-                            handle.rename_file(i, new_path)
-        
-        # Generate download ID
-        download_id = str(hash(request.magnet_link))[:16]
-        active_downloads[download_id] = handle
-        download_info[download_id] = {
-            "status": "downloading",
-            "progress": 0,
-            "name": "Fetching metadata...",
-            "download_rate": 0,
-            "upload_rate": 0,
-            "path": internal_path,
-            "start_time": datetime.now().timestamp()
-        }
-        
-        return {
-            "download_id": download_id,
-            "message": "Download started"
-        }
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error starting download: {str(e)}")
+    # Validate magnet link format
+    if not request.magnet_link or not request.magnet_link.startswith('magnet:'):
+        raise HTTPException(status_code=400, detail="Invalid magnet link format")
+    
+    # Convert display path to internal path
+    internal_path = get_internal_path(request.download_path)
+    
+    # Validate download path
+    if not os.path.exists(internal_path):
+        raise HTTPException(status_code=404, detail="Download path not found")
+    
+    download_id = await call_engine(
+        'add_magnet', request.magnet_link, internal_path, request.selected_files,
+        request.skip_parent_folder, request.flatten_all, request.streaming, request.bandwidth_class
+    )
+    
+    return {
+        "download_id": download_id,
+        "message": "Download started"
+    }
 
 
 @app.post("/api/download/file")
@@ -457,246 +447,103 @@ async def start_download_from_file(
     download_path: str = Form(...),
     selected_files: str = Form(None),
     skip_parent_folder: bool = Form(False),
-    flatten_all: bool = Form(False)
+    flatten_all: bool = Form(False),
+    streaming: bool = Form(False),
+    bandwidth_class: str = Form(None)
 ):
     """Start downloading a torrent from an uploaded .torrent file"""
-    try:
-        # Validate file extension
-        if not file.filename.endswith('.torrent'):
-            raise HTTPException(status_code=400, detail="Invalid file type. Please upload a .torrent file")
-        
-        # Convert display path to internal path
-        internal_path = get_internal_path(download_path)
-        
-        # Validate download path
-        if not os.path.exists(internal_path):
-            raise HTTPException(status_code=404, detail="Download path not found")
-        
-        # Read the file content into memory (not saving to disk)
-        torrent_data = await file.read()
-        
-        if not torrent_data:
-            raise HTTPException(status_code=400, detail="Torrent file is empty")
-        
-        # Create torrent info from the file data
-        try:
-            torrent_info = lt.torrent_info(torrent_data)
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Invalid torrent file: {str(e)}")
-        
-        # Add torrent to session
-        params = {
-            'save_path': internal_path,
-            'storage_mode': lt.storage_mode_t.storage_mode_sparse,
-            'ti': torrent_info
-        }
-        
-        try:
-            handle = torrent_session.add_torrent(params)
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Failed to add torrent: {str(e)}")
-        
-        # Verify handle is valid
-        if not handle.is_valid():
-            raise HTTPException(status_code=400, detail="Failed to add torrent - invalid torrent")
-        
-        # Parse selected_files from JSON string
-        selected_files_list = None
-        if selected_files:
-            import json
-            try:
-                selected_files_list = json.loads(selected_files)
-            except:
-                pass
-        
-        # Handle file selection
-        if selected_files_list is not None:
-            num_files = torrent_info.num_files()
-            # Set file priorities: 0 = don't download, 4 = normal priority
-            for i in range(num_files):
-                if i in selected_files_list:
-                    handle.file_priority(i, 4)
-                else:
-                    handle.file_priority(i, 0)
-        
-        # Handle skip parent folder option or flatten all
-        file_storage = torrent_info.files()
-        for i in range(torrent_info.num_files()):
-            original_path = file_storage.file_path(i)
-            
-            if flatten_all:
-                # Flatten all - keep only the filename
-                new_path = os.path.basename(original_path)
-                handle.rename_file(i, new_path)
-            elif skip_parent_folder:
-                # Remove only the first directory from the path
-                path_parts = original_path.split('/', 1)
-                if len(path_parts) > 1:
-                    new_path = path_parts[1]
-                    handle.rename_file(i, new_path)
-        
-        # Generate download ID from torrent info hash
-        download_id = str(torrent_info.info_hash())[:16]
-        active_downloads[download_id] = handle
-        download_info[download_id] = {
-            "status": "downloading",
-            "progress": 0,
-            "name": torrent_info.name(),
-            "download_rate": 0,
-            "upload_rate": 0,
-            "path": internal_path,
-            "start_time": datetime.now().timestamp()
-        }
-        
-        return {
-            "download_id": download_id,
-            "message": "Download started"
-        }
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error starting download: {str(e)}")
-
-
-@app.get("/api/progress/{download_id}")
-async def get_progress(download_id: str):
-    """Get download progress for a specific torrent"""
-    if download_id not in active_downloads:
-        raise HTTPException(status_code=404, detail="Download not found")
-    
-    handle = active_downloads[download_id]
+    # Validate file extension
+    if not file.filename.endswith('.torrent'):
+        raise HTTPException(status_code=400, detail="Invalid file type. Please upload a .torrent file")
     
-    # Check if handle is valid
-    if not handle.is_valid():
-        # Remove invalid handle
-        del active_downloads[download_id]
-        if download_id in download_info:
-            download_info[download_id]["status"] = "error"
-        raise HTTPException(status_code=410, detail="Download failed or was removed")
+    # Convert display path to internal path
+    internal_path = get_internal_path(download_path)
     
-    status = handle.status()
+    # Validate download path
+    if not os.path.exists(internal_path):
+        raise HTTPException(status_code=404, detail="Download path not found")
     
-    # Check for errors
-    if status.error:
-        error_msg = status.error
-        download_info[download_id] = {
-            "status": "error",
-            "progress": status.progress * 100,
-            "name": status.name or "Unknown",
-            "download_rate": 0,
-            "upload_rate": 0,
-            "num_seeds": 0,
-            "num_peers": 0,
-            "total_download": 0,
-            "total_upload": 0,
-            "error": error_msg
-        }
-        # Remove from active downloads
-        del active_downloads[download_id]
-        return download_info[download_id]
+    # Read the file content into memory (not saving to disk)
+    torrent_data = await file.read()
     
-    # Get total size from torrent info (only for files with priority > 0)
-    total_size = 0
-    try:
-        torrent_info = handle.torrent_file()
-        if torrent_info:
-            num_files = torrent_info.num_files()
-            file_storage = torrent_info.files()
-            # Calculate size only for files that are being downloaded
-            for i in range(num_files):
-                if handle.file_priority(i) > 0:
-                    total_size += file_storage.file_size(i)
-            total_size = total_size / (1024 * 1024)  # Convert to MB
-            
-            # If no files have priority set (all selected), use total size
-            if total_size == 0:
-                total_size = torrent_info.total_size() / (1024 * 1024)
-    except:
-        pass
+    if not torrent_data:
+        raise HTTPException(status_code=400, detail="Torrent file is empty")
     
-    # Calculate ETA
-    eta_seconds = 0
-    if status.download_rate > 0 and total_size > 0:
-        remaining_mb = total_size - (status.total_download / (1024 * 1024))
-        remaining_bytes = remaining_mb * 1024 * 1024
-        eta_seconds = int(remaining_bytes / status.download_rate)
+    # Parse selected_files from JSON string
+    selected_files_list = None
+    if selected_files:
+        try:
+            selected_files_list = json.loads(selected_files)
+        except:
+            pass
     
-    # Calculate elapsed time
-    elapsed_seconds = 0
-    start_time = None
-    if download_id in download_info and 'start_time' in download_info[download_id]:
-        start_time = download_info[download_id]['start_time']
-        elapsed_seconds = int(datetime.now().timestamp() - start_time)
+    download_id = await call_engine(
+        'add_torrent_file', torrent_data, internal_path, selected_files_list,
+        skip_parent_folder, flatten_all, streaming, bandwidth_class
+    )
     
-    info = {
-        "status": "downloading" if not status.is_seeding else "completed",
-        "progress": status.progress * 100,
-        "name": status.name,
-        "download_rate": status.download_rate / 1024,  # KB/s
-        "upload_rate": status.upload_rate / 1024,  # KB/s
-        "num_seeds": status.num_seeds,
-        "num_peers": status.num_peers,
-        "total_download": status.total_download / (1024 * 1024),  # MB
-        "total_upload": status.total_upload / (1024 * 1024),  # MB
-        "total_size": total_size,  # MB
-        "eta_seconds": eta_seconds,  # Estimated time remaining in seconds
-        "elapsed_seconds": elapsed_seconds,  # Time elapsed since download started
-        "start_time": start_time,  # Preserve start time for future calculations
+    return {
+        "download_id": download_id,
+        "message": "Download started"
     }
-    
-    download_info[download_id] = info
-    
-    # Auto-cleanup if completed
-    if status.is_seeding and status.progress >= 1.0:
-        info["status"] = "completed"
-    
-    return info
+
+
+@app.get("/api/progress/{download_id}")
+async def get_progress(download_id: str):
+    """Get download progress for a specific torrent"""
+    return await call_engine('get_progress', download_id)
 
 
 @app.post("/api/cancel")
 async def cancel_download(request: CancelRequest):
     """Cancel an active download and delete partial files"""
-    if request.download_id not in active_downloads:
-        raise HTTPException(status_code=404, detail="Download not found")
-    
-    handle = active_downloads[request.download_id]
-    
-    # Get torrent info before removing
-    try:
-        status = handle.status()
-        torrent_info = handle.torrent_file()
-        save_path = status.save_path
-        
-        # Get the name/folder of the download
-        if torrent_info:
-            download_name = torrent_info.name()
-        else:
-            download_name = status.name
-        
-        # Remove torrent from session with delete files option
-        torrent_session.remove_torrent(handle, lt.options_t.delete_files)
-        
-        # Additional cleanup: manually delete the folder/file if it still exists
-        if download_name and save_path:
-            download_path = os.path.join(save_path, download_name)
-            if os.path.exists(download_path):
-                try:
-                    if os.path.isfile(download_path):
-                        os.remove(download_path)
-                    elif os.path.isdir(download_path):
-                        shutil.rmtree(download_path)
-                except Exception as e:
-                    print(f"Error deleting files: {e}")
-    except Exception as e:
-        print(f"Error during cleanup: {e}")
-        # Still remove from tracking even if cleanup fails
-        torrent_session.remove_torrent(handle)
+    await call_engine('cancel_download', request.download_id)
+    return {"message": "Download cancelled and files deleted"}
+
+
+@app.get("/api/bandwidth")
+async def get_bandwidth():
+    """Get the current global limits, the schedule and the available bandwidth classes (KB/s)"""
+    return await call_engine('get_bandwidth')
+
+
+@app.post("/api/bandwidth/class")
+async def set_download_bandwidth_class(request: BandwidthClassRequest):
+    """Change the bandwidth class of an active download"""
+    await call_engine('set_bandwidth_class', request.download_id, request.bandwidth_class)
+    return {"message": "Bandwidth class updated"}
+
+
+@app.get("/api/stream/{download_id}/{file_index}")
+async def stream_file(download_id: str, file_index: int, request: Request):
+    """Stream a file of an active download, serving byte ranges as soon as their pieces are downloaded"""
+    file_meta = await call_engine('get_stream_file', download_id, file_index)
+    file_path = file_meta['path']
+    file_size = file_meta['size']
+    if file_size == 0:
+        raise HTTPException(status_code=416, detail="File is empty")
+    media_type = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+    headers = {"Accept-Ranges": "bytes"}
     
-    del active_downloads[request.download_id]
-    if request.download_id in download_info:
-        download_info[request.download_id]["status"] = "cancelled"
+    range_header = request.headers.get('range')
+    if range_header:
+        byte_range = parse_range_header(range_header, file_size)
+        if byte_range is None:
+            raise HTTPException(status_code=416, detail="Invalid range", headers={"Content-Range": f"bytes */{file_size}"})
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+    else:
+        start, end = 0, file_size - 1
+        status_code = 200
+    headers["Content-Length"] = str(end - start + 1)
     
-    return {"message": "Download cancelled and files deleted"}
+    return StreamingResponse(
+        iter_stream(download_id, file_index, start, end),
+        status_code=status_code,
+        media_type=media_type,
+        headers=headers
+    )
 
 
 @app.get("/api/plex/health")
@@ -747,16 +594,7 @@ async def refresh_plex_library(request: PlexRefreshRequest):
         
         # Clean up any completed downloads from active tracking
         # This helps free up memory for completed downloads
-        completed_ids = []
-        for download_id, info in download_info.items():
-            if info.get('status') == 'completed':
-                completed_ids.append(download_id)
-        
-        for download_id in completed_ids:
-            if download_id in active_downloads:
-                del active_downloads[download_id]
-            if download_id in download_info:
-                del download_info[download_id]
+        await call_engine('remove_completed_downloads')
         
         return {"message": f"Library '{request.library_name}' refresh started"}
     except Exception as e:
@@ -767,8 +605,22 @@ async def refresh_plex_library(request: PlexRefreshRequest):
 app.mount("/", StaticFiles(directory="web", html=True), name="web")
 
 
+def run_engine():
+    """Entry point of the torrent engine process"""
+    import engine
+    engine.serve()
+
+
 if __name__ == "__main__":
     import uvicorn
+    import secrets
+    import multiprocessing
     # Create web directory if it doesn't exist
     os.makedirs("web", exist_ok=True)
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Shared secret for the engine socket, inherited by the engine and the HTTP workers
+    os.environ.setdefault('ENGINE_AUTHKEY', secrets.token_hex(16))
+    # A single process owns the torrent session so the HTTP layer can run several workers
+    engine_process = multiprocessing.Process(target=run_engine, name='torrent-engine', daemon=True)
+    engine_process.start()
+    rpc.wait_for_engine()
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=WORKERS)
@@ -0,0 +1,87 @@
+import os
+import time
+import threading
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+from typing import Callable, Dict
+
+# Unix socket the torrent engine listens on
+ENGINE_SOCKET = os.getenv('ENGINE_SOCKET', '/tmp/plexy-engine.sock')
+
+
+class EngineError(Exception):
+    """Error raised by the torrent engine, carrying the HTTP status to report"""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(status_code, detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def get_authkey() -> bytes:
+    """Get the shared secret used to authenticate engine connections"""
+    return os.environ.get('ENGINE_AUTHKEY', '').encode()
+
+
+def call(method: str, *args):
+    """Call a method of the torrent engine and return its result"""
+    if not get_authkey():
+        raise EngineError(503, "Torrent engine is not available: ENGINE_AUTHKEY is not set")
+    try:
+        with Client(ENGINE_SOCKET, family='AF_UNIX', authkey=get_authkey()) as conn:
+            conn.send((method, args))
+            status, result = conn.recv()
+    except AuthenticationError:
+        raise EngineError(503, "Torrent engine is not available: ENGINE_AUTHKEY does not match the engine")
+    except (EOFError, OSError):
+        # Missing socket, engine not listening or engine exiting mid-call
+        raise EngineError(503, "Torrent engine is not available")
+
+    if status == 'error':
+        raise result
+    return result
+
+
+def wait_for_engine(timeout: int = 30):
+    """Wait until the torrent engine accepts connections"""
+    start_time = time.time()
+    while True:
+        try:
+            return call('ping')
+        except EngineError:
+            if time.time() - start_time > timeout:
+                raise
+            time.sleep(0.1)
+
+
+def handle_connection(conn, methods: Dict[str, Callable]):
+    """Run a single engine call and send back its result"""
+    with conn:
+        try:
+            method, args = conn.recv()
+            if method not in methods:
+                raise EngineError(400, f"Unknown engine method: {method}")
+            response = ('ok', methods[method](*args))
+        except EngineError as e:
+            response = ('error', e)
+        except Exception as e:
+            response = ('error', EngineError(500, str(e)))
+        conn.send(response)
+
+
+def serve(methods: Dict[str, Callable]):
+    """Serve engine calls on the Unix socket, one thread per connection"""
+    # Calls are pickled, never accept them from unauthenticated clients
+    if not get_authkey():
+        raise RuntimeError("ENGINE_AUTHKEY must be set to run the torrent engine")
+    if os.path.exists(ENGINE_SOCKET):
+        os.remove(ENGINE_SOCKET)
+
+    with Listener(ENGINE_SOCKET, family='AF_UNIX', authkey=get_authkey()) as listener:
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                print(f"Error accepting engine connection: {e}")
+                continue
+            threading.Thread(target=handle_connection, args=(conn, methods), daemon=True).start()